@@ -4,24 +4,26 @@ import getopt
 import os
 import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from enum import Enum, unique
 from pathlib import Path
 from typing import Callable, Mapping, Optional, SupportsFloat, Tuple, Type
 from typing_extensions import TypeAlias
 
-import matplotlib.pyplot as plt
 import numpy as np
 import rasterio
 import rasterio.crs
+import rasterio.io
 import rasterio.transform
+from PIL import Image
 
 from dataclasses import dataclass
 
 
 Tags: TypeAlias = Mapping[str, Optional[str]]
-BandData: TypeAlias = Mapping["Band", np.ma.masked_array]
-IndexFunction = Callable[[BandData], np.ma.masked_array]
+BandData: TypeAlias = Mapping["Band", np.ndarray]
+IndexFunction = Callable[[BandData], np.ndarray]
 
 fixed_tags = (
     "add_offset",
@@ -43,6 +45,39 @@ fixed_tags = (
     "ULY",
 )
 
+# Number of raster rows per block when computing an index.  A block of each band is
+# then a few megabytes at most, even for the widest (3660 pixel) HLS tiles.
+block_rows = 64
+
+# GDAL configuration options in effect while reading input bands.  HLS bands are
+# tiled, compressed GeoTIFFs, so decoding is spread across all CPUs (GDAL >= 3.6),
+# and the block cache is sized to hold every band of a granule.  The remaining
+# options avoid listing the directory on every open, and, when the input directory
+# is remote (e.g., /vsis3/...), avoid a HEAD request on every open and let GDAL
+# merge the range requests for the tiles it reads.
+gdal_read_options = dict(
+    GDAL_NUM_THREADS="ALL_CPUS",
+    GDAL_CACHEMAX=512,
+    GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR",
+    CPL_VSIL_CURL_USE_HEAD="NO",
+    GDAL_HTTP_MERGE_CONSECUTIVE_RANGES="YES",
+)
+
+# Assume granule IDs are formatted as follows, where {version} may contain dots:
+# HLS.{instrument}.{tile_id}.{acquisition_date}.{version}
+granule_id_pattern = re.compile(
+    r"HLS[.](?P<instrument>[^.]+)[.](?P<tile_id>[^.]+)[.]"
+    r"(?P<acquisition_date>[^.]+)[.](?P<version>.+)"
+)
+
+# GDAL creation options for each supported compression of the output GeoTIFFs.
+# Deflate is the default, because not every consumer of the products can decode
+# zstd, which compresses about as well at a lower CPU cost.
+compression_options = {
+    "deflate": dict(compress="deflate"),
+    "zstd": dict(compress="zstd", zstd_level=3),
+}
+
 
 @unique
 class Band(Enum):
@@ -96,11 +131,10 @@ class Instrument(Enum):
 
     @classmethod
     def named(cls, name: str) -> "Instrument":
-        for instrument in cls:
-            if instrument.name == name:
-                return instrument
-
-        raise ValueError(f"Invalid instrument name: {name}")
+        try:
+            return cls[name]
+        except KeyError:
+            raise ValueError(f"Invalid instrument name: {name}") from None
 
     def satellite(self, tags: Tags) -> str:
         return self.parse_satellite(tags)
@@ -115,13 +149,7 @@ class GranuleId:
 
     @classmethod
     def from_string(cls, granule_id: str) -> "GranuleId":
-        # Assume granule_id is formatted as follows, where {version} may contain dots:
-        # HLS.{instrument}.{tile_id}.{acquisition_date}.{version}
-        match = re.match(
-            r"HLS[.](?P<instrument>[^.]+)[.](?P<tile_id>[^.]+)[.]"
-            r"(?P<acquisition_date>[^.]+)[.](?P<version>.+)",
-            granule_id,
-        )
+        match = granule_id_pattern.match(granule_id)
 
         if not match:
             raise ValueError(f"Invalid granule ID: {granule_id}")
@@ -156,38 +184,91 @@ class Granule:
 
 def read_granule_bands(input_dir: Path, id_str: str) -> Granule:
     id_ = GranuleId.from_string(id_str)
-
-    with rasterio.open(input_dir / f"{id_}.Fmask.tif") as tif:
-        fmask = tif.read(1, masked=False)
-
     tifnames = [f"{id_}.{band.name}.tif" for band in id_.instrument.bands]
-    data = [apply_fmask(read_band(input_dir / tifname), fmask) for tifname in tifnames]
-    harmonized_bands = [band.value for band in id_.instrument.bands]
 
-    # Every band has the same CRS, transform, and tags, so we can use the first one to
-    # get this information.
-    with rasterio.open(input_dir / tifnames[0]) as tif:
+    paths = [input_dir / tifname for tifname in tifnames]
+
+    # Every band has the same CRS, transform, tags, and shape, so we can use the first
+    # one to get this information, and read its data from the same open dataset, so
+    # that no file is opened twice.
+    with rasterio.Env(**gdal_read_options), rasterio.open(paths[0]) as tif:
         crs = tif.crs
         transform = tif.transform
         tags = select_tags(id_, tif.tags())
 
+        # Scale every band straight into its slice of a single preallocated
+        # (band, row, column) buffer, rather than allocating each band separately.
+        # Each concurrent read also gets a slice of a matching buffer of the stored
+        # (int16) values to read into, before scaling them.
+        bands = np.empty((len(paths), *tif.shape))
+        stored = np.empty((len(paths), *tif.shape), dtype=np.int16)
+
+        # Read the Fmask and the remaining bands concurrently, while reading the
+        # first band here.  GDAL releases the GIL while decoding, so the reads (and
+        # decompression) of the individual files overlap.
+        with ThreadPoolExecutor(max_workers=len(paths)) as ex:
+            fmask_future = ex.submit(read_fmask, input_dir / f"{id_}.Fmask.tif")
+            futures = [
+                ex.submit(read_band, path, out, scratch)
+                for path, out, scratch in zip(paths[1:], bands[1:], stored[1:])
+            ]
+
+            read_reflectance(tif, bands[0], stored[0])
+            fmask = fmask_future.result()
+
+            # Re-raise any exception raised while reading a band.
+            for future in futures:
+                future.result()
+
+    data = [apply_fmask(band, fmask) for band in bands]
+    harmonized_bands = [band.value for band in id_.instrument.bands]
+
     return Granule(id_, crs, transform, tags, dict(zip(harmonized_bands, data)))
 
 
-def read_band(tif_path: Path) -> np.ma.masked_array:
+def read_fmask(tif_path: Path) -> np.ndarray:
+    with rasterio.open(tif_path) as tif:
+        return tif.read(1, masked=False)
+
+
+def read_band(tif_path: Path, out: np.ndarray, scratch: np.ndarray) -> np.ndarray:
     with rasterio.open(tif_path) as tif:
-        data = tif.read(1, masked=True, fill_value=-9999) / 10_000
+        return read_reflectance(tif, out, scratch)
 
-    # Clamp surface reflectance values to the range [0, 1].
-    return np.ma.masked_outside(data, 0, 1)
 
+def read_reflectance(
+    tif: rasterio.io.DatasetReader, out: np.ndarray, scratch: np.ndarray
+) -> np.ndarray:
+    # Invalid pixels are represented by NaN rather than by a masked array, so that
+    # index arithmetic runs on plain ndarrays and NaN propagates through it.
+    # The band is read into `scratch`, in the file's own (int16) type, because older
+    # versions of rasterio reject an `out` array of a different type, and is then
+    # scaled straight into `out`, so that reading allocates no raster of its own.
+    stored = tif.read(1, out=scratch)
 
-def apply_fmask(data: np.ndarray, fmask: np.ndarray) -> np.ma.masked_array:
+    # Clamp surface reflectance values to the range [0, 1], along with nodata, by
+    # masking the stored values outside [0, 10_000] in a single assignment.  Viewed
+    # as unsigned, negative values wrap around to values above 32767, so a single
+    # comparison finds them.  The nodata value (-9999 for HLS) normally lies outside
+    # that range already, so it only needs a comparison of its own when it does not.
+    invalid = stored.view(np.uint16) > 10_000
+
+    if tif.nodata is not None and 0 <= tif.nodata <= 10_000:
+        invalid |= stored == tif.nodata
+
+    np.divide(stored, 10_000, out=out)
+    out[invalid] = np.nan
+
+    return out
+
+
+def apply_fmask(data: np.ndarray, fmask: np.ndarray) -> np.ndarray:
     # Per Table 9 in https://lpdaac.usgs.gov/documents/1698/HLS_User_Guide_V2.pdf
     # we wish to mask data where the Fmask has any one of the following bits set:
     # cloud shadow (bit 3), adjacent to cloud/shadow (bit 2), cloud (bit 1).
     cloud_like = int("00001110", 2)
-    return np.ma.masked_array(data, fmask & cloud_like != 0)
+    data[fmask & cloud_like != 0] = np.nan
+    return data
 
 
 def select_tags(granule_id: GranuleId, tags: Tags) -> Tags:
@@ -207,12 +288,18 @@ def select_tags(granule_id: GranuleId, tags: Tags) -> Tags:
     }
 
 
-def write_granule_indices(output_dir: Path, granule: Granule):
+def write_granule_indices(
+    output_dir: Path, granule: Granule, compression: str = "deflate"
+):
+    if compression not in compression_options:
+        raise ValueError(f"Invalid compression: {compression}")
+
     os.makedirs(output_dir, exist_ok=True)
     processing_time = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
 
-    for index in Index:
-        output_path = output_dir / ".".join(
+    output_paths = {
+        index: output_dir
+        / ".".join(
             [
                 "HLS-VI",
                 granule.id_.instrument.name,
@@ -223,8 +310,32 @@ def write_granule_indices(output_dir: Path, granule: Granule):
                 "tif",
             ]
         )
+        for index in Index
+    }
 
-        write_granule_index(output_path, granule, index, processing_time)
+    # The indices are independent of one another, and both NumPy and GDAL (while
+    # compressing) release the GIL, so compute and write them concurrently.
+    with ThreadPoolExecutor(max_workers=min(len(Index), os.cpu_count() or 1)) as ex:
+        results = ex.map(
+            lambda index: write_granule_index(
+                output_paths[index], granule, index, processing_time, compression
+            ),
+            Index,
+        )
+
+        # Consuming the results re-raises any exception raised while writing an
+        # index.  Only the NDVI data is kept (for the browse image), so that every
+        # other index is released as soon as it is written.
+        for index, data in zip(Index, results):
+            if index is Index.NDVI:
+                ndvi = data
+
+    # Create browse image using NDVI.  This is done here, after the workers are
+    # done, rather than in the worker that wrote the NDVI, so that only one thread
+    # encodes images.
+    write_browse_image(
+        output_paths[Index.NDVI].with_suffix(".jpeg"), ndvi, Index.NDVI.fill_value
+    )
 
 
 def write_granule_index(
@@ -232,8 +343,9 @@ def write_granule_index(
     granule: Granule,
     index: "Index",
     processing_time: str,
-):
-    """Save raster data to a GeoTIFF file using rasterio."""
+    compression: str = "deflate",
+) -> np.ndarray:
+    """Save raster data to a GeoTIFF file using rasterio, and return the data."""
 
     data = index(granule.data)
 
@@ -241,84 +353,137 @@ def write_granule_index(
         output_path,
         "w",
         driver="GTiff",
-        compress="deflate",
+        **compression_options[compression],
+        # Horizontal differencing makes the smoothly varying index values compress
+        # considerably better, and 512x512 tiles allow downstream readers to fetch
+        # only the part of the raster they need.
+        predictor=2,
+        tiled=True,
+        blockxsize=512,
+        blockysize=512,
+        bigtiff="IF_SAFER",
         width=data.shape[1],
         height=data.shape[0],
         count=1,
         dtype=data.dtype,
         crs=granule.crs,
         transform=granule.transform,
-        nodata=data.fill_value,
+        nodata=index.fill_value,
+        num_threads="all_cpus",
     ) as dst:
         dst.offsets = (0.0,)
         dst.scales = (index.scale_factor,)
-        dst.write(data.filled(), 1)
+        dst.write(data, 1)
         dst.update_tags(
             **granule.tags,
             long_name=index.long_name,
             scale_factor=index.scale_factor,
             HLS_VI_PROCESSING_TIME=processing_time,
-            _FillValue=data.fill_value,
+            _FillValue=index.fill_value,
         )
 
-    # Create browse image using NDVI
-    if index == Index.NDVI:
-        plt.imsave(str(output_path.with_suffix(".jpeg")), data, dpi=300, cmap="gray")
+    return data
+
 
+def write_browse_image(output_path: Path, data: np.ndarray, fill_value: int):
+    # Stretch the valid index values across all gray levels and show fill values as
+    # white, as the grayscale browse images previously rendered by matplotlib did.
+    # Like matplotlib's colormaps, split the range into 256 equal bins, with the
+    # maximum in the top one.
+    valid = data != fill_value
+    values = data[valid].astype(np.int32)
+    browse = np.full(data.shape, 255, dtype=np.uint8)
 
-def evi(data: BandData) -> np.ma.masked_array:
+    if values.size:
+        low, high = values.min(), values.max()
+        browse[valid] = np.minimum((values - low) * 256 // max(high - low, 1), 255)
+
+    # Save an RGB (rather than single channel) JPEG, which is the format of the
+    # browse images matplotlib wrote.
+    Image.fromarray(browse, mode="L").convert("RGB").save(output_path, dpi=(300, 300))
+
+
+def evi(data: BandData) -> np.ndarray:
     b, r, nir = data[Band.B], data[Band.R], data[Band.NIR]
-    return 2.5 * (nir - r) / (nir + 6 * r - 7.5 * b + 1)  # type: ignore
+    # Evaluate 2.5 * (nir - r) / (nir + 6 * r - 7.5 * b + 1) in place, so that only
+    # the numerator and denominator are allocated, rather than a temporary for every
+    # intermediate term.
+    numerator = nir - r
+    numerator *= 2.5
+    denominator = r * 6
+    denominator += nir
+    denominator -= b * 7.5
+    denominator += 1
+    numerator /= denominator
 
+    return numerator
 
-def msavi(data: BandData) -> np.ma.masked_array:
+
+def msavi(data: BandData) -> np.ndarray:
     r, nir = data[Band.R], data[Band.NIR]
-    sqrt_term = (2 * nir + 1) ** 2 - 8 * (nir - r)  # type: ignore
+    two_nir_plus_1 = nir * 2
+    two_nir_plus_1 += 1
+    sqrt_term = two_nir_plus_1 ** 2
+    sqrt_term -= (nir - r) * 8
+    # The term equals (2 * nir - 1) ** 2 + 8 * r, which cannot be negative for valid
+    # (non-negative) reflectances, so clamping only guards against rounding error and
+    # needs no separate branch.  NaN (invalid) pixels remain NaN.
+    np.maximum(sqrt_term, 0, out=sqrt_term)
+    np.sqrt(sqrt_term, out=sqrt_term)
+
+    result = two_nir_plus_1
+    result -= sqrt_term
+    result /= 2
 
-    result: np.ma.masked_array = np.ma.where(
-        sqrt_term >= 0,
-        (2 * nir + 1 - np.sqrt(sqrt_term)) / 2,  # type: ignore
-        np.nan,
-    )
-    result.fill_value = r.fill_value
+    return result
 
+
+def normalized_difference(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    result = a - b
+    result /= a + b
     return result
 
 
-def nbr(data: BandData) -> np.ma.masked_array:
-    nir, swir2 = data[Band.NIR], data[Band.SWIR2]
-    return (nir - swir2) / (nir + swir2)  # type: ignore
+def nbr(data: BandData) -> np.ndarray:
+    return normalized_difference(data[Band.NIR], data[Band.SWIR2])
 
 
-def nbr2(data: BandData) -> np.ma.masked_array:
-    swir1, swir2 = data[Band.SWIR1], data[Band.SWIR2]
-    return (swir1 - swir2) / (swir1 + swir2)  # type: ignore
+def nbr2(data: BandData) -> np.ndarray:
+    return normalized_difference(data[Band.SWIR1], data[Band.SWIR2])
 
 
-def ndmi(data: BandData) -> np.ma.masked_array:
-    nir, swir1 = data[Band.NIR], data[Band.SWIR1]
-    return (nir - swir1) / (nir + swir1)  # type: ignore
+def ndmi(data: BandData) -> np.ndarray:
+    return normalized_difference(data[Band.NIR], data[Band.SWIR1])
 
 
-def ndvi(data: BandData) -> np.ma.masked_array:
-    r, nir = data[Band.R], data[Band.NIR]
-    return (nir - r) / (nir + r)  # type: ignore
+def ndvi(data: BandData) -> np.ndarray:
+    return normalized_difference(data[Band.NIR], data[Band.R])
 
 
-def ndwi(data: BandData) -> np.ma.masked_array:
-    g, nir = data[Band.G], data[Band.NIR]
-    return (g - nir) / (g + nir)  # type: ignore
+def ndwi(data: BandData) -> np.ndarray:
+    return normalized_difference(data[Band.G], data[Band.NIR])
 
 
-def savi(data: BandData) -> np.ma.masked_array:
+def savi(data: BandData) -> np.ndarray:
     r, nir = data[Band.R], data[Band.NIR]
-    return 1.5 * (nir - r) / (nir + r + 0.5)  # type: ignore
+    numerator = nir - r
+    numerator *= 1.5
+    denominator = nir + r
+    denominator += 0.5
+    numerator /= denominator
+
+    return numerator
 
 
-def tvi(data: BandData) -> np.ma.masked_array:
+def tvi(data: BandData) -> np.ndarray:
     g, r, nir = data[Band.G], data[Band.R], data[Band.NIR]
     # We do NOT multiply by 10_000 like we do for other indices.
-    return (120 * (nir - g) - 200 * (r - g)) / 2  # type: ignore
+    result = nir - g
+    result *= 120
+    result -= (r - g) * 200
+    result /= 2
+
+    return result
 
 
 class Index(Enum):
@@ -332,7 +497,12 @@ class Index(Enum):
     SAVI = ("Soil-Adjusted Vegetation Index",)
     TVI = ("Triangular Vegetation Index", 1.0)
 
-    def __init__(self, long_name: str, scale_factor: SupportsFloat = 0.0001) -> None:
+    def __init__(
+        self,
+        long_name: str,
+        scale_factor: SupportsFloat = 0.0001,
+        fill_value: int = -9999,
+    ) -> None:
         function_name = self.name.lower()
         index_function: Optional[IndexFunction] = globals().get(function_name)
 
@@ -342,17 +512,48 @@ class Index(Enum):
         self.long_name = long_name
         self.compute_index = index_function
         self.scale_factor = float(scale_factor)
-
-    def __call__(self, data: BandData) -> np.ma.masked_array:
-        scaled_index = self.compute_index(data) / self.scale_factor
-        return np.ma.round(scaled_index).astype(np.int16)
-
-
-def parse_args() -> Tuple[Path, Path, str]:
-    short_options = "i:o:s:"
-    long_options = ["inputdir=", "outputdir=", "idstring="]
+        self.fill_value = fill_value
+
+    def __call__(self, data: BandData) -> np.ndarray:
+        shape = data[Band.NIR].shape
+        result = np.empty(shape, dtype=np.int16)
+
+        # Evaluate the index a block of rows at a time, so that the temporaries of
+        # each block (including subexpressions such as nir - r that several index
+        # formulas have in common) stay in CPU cache rather than streaming full
+        # rasters through memory for every arithmetic step.
+        for start in range(0, shape[0], block_rows):
+            rows = slice(start, start + block_rows)
+            block_data = {band: values[rows] for band, values in data.items()}
+            result[rows] = self.compute_block(block_data)
+
+        return result
+
+    def compute_block(self, data: BandData) -> np.ndarray:
+        # Division by zero and arithmetic on NaN (invalid) pixels are expected, and
+        # are handled below, so there is no need for NumPy to report them.
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # Every index function returns a newly allocated array, so scale, fill
+            # and round it in place.
+            scaled_index = self.compute_index(data)
+            scaled_index /= self.scale_factor
+
+        # NaN marks pixels that were invalid in any input band, and infinity marks
+        # pixels where the index formula divided by zero.
+        scaled_index[~np.isfinite(scaled_index)] = self.fill_value
+        np.round(scaled_index, out=scaled_index)
+
+        return scaled_index
+
+
+def parse_args() -> Tuple[Path, Path, str, str]:
+    short_options = "i:o:s:c:"
+    long_options = ["inputdir=", "outputdir=", "idstring=", "compression="]
     command = os.path.basename(sys.argv[0])
-    help_text = f"usage: {command} -i <input_dir> -o <output_dir> -s <id_string>"
+    help_text = (
+        f"usage: {command} -i <input_dir> -o <output_dir> -s <id_string>"
+        f" [-c {'|'.join(compression_options)}]"
+    )
 
     argv = sys.argv[1:]
 
@@ -362,7 +563,7 @@ def parse_args() -> Tuple[Path, Path, str]:
         print(help_text, file=sys.stderr)
         sys.exit(2)
 
-    input_dir, output_dir, id_str = None, None, None
+    input_dir, output_dir, id_str, compression = None, None, None, "deflate"
 
     for option, value in options:
         if option in ("-i", "--inputdir"):
@@ -371,17 +572,25 @@ def parse_args() -> Tuple[Path, Path, str]:
             output_dir = value
         elif option in ("-s", "--idstring"):
             id_str = value
-
-    if input_dir is None or output_dir is None or id_str is None:
+        elif option in ("-c", "--compression"):
+            compression = value
+
+    if (
+        input_dir is None
+        or output_dir is None
+        or id_str is None
+        or compression not in compression_options
+    ):
         print(help_text, file=sys.stderr)
         sys.exit(2)
 
-    return Path(input_dir), Path(output_dir), id_str
+    return Path(input_dir), Path(output_dir), id_str, compression
 
 
 def main():
-    input_dir, output_dir, id_str = parse_args()
-    write_granule_indices(output_dir, read_granule_bands(input_dir, id_str))
+    input_dir, output_dir, id_str, compression = parse_args()
+    granule = read_granule_bands(input_dir, id_str)
+    write_granule_indices(output_dir, granule, compression)
 
 
 if __name__ == "__main__":
@@ -25,10 +25,16 @@ def generate_metadata(input_dir: Path, output_dir: Path):
     metadata_path = next(input_dir.glob("HLS.*.cmr.xml"))
     tree = ET.parse(metadata_path)
 
-    with rasterio.open(next(output_dir.glob("*.tif"))) as vi_tif:
-        sensing_times = vi_tif.tags()["SENSING_TIME"].split(";")
-        sensing_time_begin, sensing_time_end = sensing_times[0], sensing_times[-1]
-        processing_time = vi_tif.tags()["HLS_VI_PROCESSING_TIME"]
+    # Only the tags are needed, so don't let GDAL list the directory looking for
+    # sidecar files (e.g., .aux.xml, .ovr) while opening the GeoTIFF.
+    with rasterio.Env(GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR"), rasterio.open(
+        next(output_dir.glob("*.tif"))
+    ) as vi_tif:
+        tags = vi_tif.tags()
+
+    sensing_times = tags["SENSING_TIME"].split(";")
+    sensing_time_begin, sensing_time_end = sensing_times[0], sensing_times[-1]
+    processing_time = tags["HLS_VI_PROCESSING_TIME"]
 
     granule_ur = tree.find("GranuleUR")
     granule_ur.text = granule_ur.text.replace("HLS", "HLS-VI")
@@ -6,8 +6,8 @@ setup(
     packages=["hls_vi"],
     install_requires=[
         "dataclasses",
-        "matplotlib",
         "numpy~=1.19.0",
+        "Pillow",
         "rasterio",
         "typing-extensions",
     ],
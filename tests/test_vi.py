@@ -5,11 +5,26 @@ from xml.etree import ElementTree as ET
 import contextlib
 import io
 import os
+import sys
 
+import numpy as np
 import pytest
 import rasterio
+from rasterio.transform import Affine
 from hls_vi.generate_metadata import generate_metadata
-from hls_vi.generate_indices import read_granule_bands, write_granule_indices
+from hls_vi.generate_indices import (
+    Band,
+    Index,
+    L30Band,
+    block_rows,
+    parse_args,
+    read_granule_bands,
+    write_browse_image,
+    write_granule_indices,
+)
+from PIL import Image
+
+L30_ID_STR = "HLS.L30.T06WVS.2024120T211159.v2.0"
 
 
 def assert_tifs_equal(actual: Path, expected: Path):
@@ -71,6 +86,50 @@ def remove_datetime_elements(tree: ET.ElementTree) -> ET.ElementTree:
     return tree
 
 
+def write_l30_granule(
+    input_dir: Path, values: Mapping[Band, np.ndarray], fmask: np.ndarray
+) -> None:
+    """
+    Writes synthetic L30 band and Fmask GeoTIFFs for the granule `L30_ID_STR`.
+
+    Args:
+        input_dir: Directory to write the GeoTIFFs to.
+        values: Mapping of band to its stored (scaled by 10_000) reflectances.  Bands
+            that are not given are filled with 1000 (reflectance 0.1).
+        fmask: Fmask values, which also determine the shape of every band.
+    """
+    height, width = fmask.shape
+    profile = dict(
+        driver="GTiff",
+        width=width,
+        height=height,
+        count=1,
+        crs="EPSG:32606",
+        transform=Affine(30.0, 0.0, 399960.0, 0.0, -30.0, 7900020.0),
+    )
+
+    for l30_band in L30Band:
+        band_values = values.get(l30_band.value, np.full(fmask.shape, 1000))
+
+        with rasterio.open(
+            input_dir / f"{L30_ID_STR}.{l30_band.name}.tif",
+            "w",
+            dtype="int16",
+            nodata=-9999,
+            **profile,
+        ) as tif:
+            tif.write(band_values.astype(np.int16), 1)
+            tif.update_tags(
+                LANDSAT_PRODUCT_ID="LC08_L1TP_069014_20240429_20240430_02_RT",
+                SENSING_TIME="2024-04-29T21:11:59.123456Z",
+            )
+
+    with rasterio.open(
+        input_dir / f"{L30_ID_STR}.Fmask.tif", "w", dtype="uint8", **profile
+    ) as tif:
+        tif.write(fmask, 1)
+
+
 def assert_indices_equal(actual_dir: Path, expected_dir: Path):
     actual_tif_paths = sorted(actual_dir.glob("*.tif"))
     actual_tif_names = [path.name for path in actual_tif_paths]
@@ -144,3 +203,112 @@ def test_generate_cmr_metadata(input_dir, output_dir):
     finally:
         with contextlib.suppress(FileNotFoundError):
             actual_metadata_path.unlink()
+
+
+def test_invalid_pixels_are_filled(tmp_path: Path):
+    # The height is not a multiple of block_rows, so that the last, partial block of
+    # rows is computed too.  The special cases are all in that block.
+    height, width = 2 * block_rows + 3, 5
+    nir = np.full((height, width), 3000)
+    red = np.full((height, width), 1000)
+    fmask = np.zeros((height, width), dtype=np.uint8)
+
+    red[-1, 0] = -9999  # nodata
+    red[-1, 1] = 10_001  # reflectance above 1
+    fmask[-1, 2] = 0b00000010  # cloud
+    nir[-1, 3], red[-1, 3] = 0, 0  # NDVI divides by zero
+    nir[-1, 4], red[-1, 4] = 5000, 0
+
+    write_l30_granule(tmp_path, {Band.NIR: nir, Band.R: red}, fmask)
+    granule = read_granule_bands(tmp_path, L30_ID_STR)
+    ndvi = Index.NDVI(granule.data)
+    msavi = Index.MSAVI(granule.data)
+
+    assert ndvi.dtype == msavi.dtype == np.int16
+    assert ndvi.shape == msavi.shape == (height, width)
+    assert (ndvi[:-1] == 5000).all()
+    assert (msavi[:-1] == 3101).all()
+    assert ndvi[-1].tolist() == [-9999, -9999, -9999, -9999, 10_000]
+    assert msavi[-1].tolist() == [-9999, -9999, -9999, 0, 10_000]
+
+
+def test_msavi_clamps_negative_rounding_error():
+    data = {band: np.zeros((1, 1)) for band in Band}
+    data[Band.NIR][0, 0] = 0.50000001
+
+    # The square-root term, (2 * nir + 1) ** 2 - 8 * (nir - r), equals
+    # (2 * nir - 1) ** 2 + 8 * r, but rounding makes it slightly negative here.
+    nir = data[Band.NIR]
+    assert ((nir * 2 + 1) ** 2 - nir * 8)[0, 0] < 0
+
+    assert Index.MSAVI(data).tolist() == [[10_000]]
+
+
+def test_write_browse_image(tmp_path: Path):
+    # Uniform 16x16 blocks (the JPEG coding unit), so that JPEG compression leaves
+    # the block values (nearly) intact: fill, minimum, midpoint, and maximum.
+    data = np.repeat(np.array([[-9999, -2000, 3000, 8000]], dtype=np.int16), 16, axis=1)
+    data = np.repeat(data, 16, axis=0)
+    output_path = tmp_path / "browse.jpeg"
+
+    write_browse_image(output_path, data, -9999)
+
+    with Image.open(output_path) as image:
+        assert image.format == "JPEG"
+        assert image.mode == "RGB"
+        assert image.size == (64, 16)
+        pixels = np.asarray(image).astype(int)
+
+    expected = np.array([255, 0, 128, 255])
+    actual = pixels[8, 8::16]
+
+    # Every channel is equal (gray), and within JPEG rounding of the stretch.
+    assert (actual == actual[:, :1]).all()
+    assert (np.abs(actual[:, 0] - expected) <= 1).all()
+
+
+@pytest.mark.parametrize(
+    argnames="compression_args",
+    argvalues=[["-c", "zstd"], ["--compression", "zstd"]],
+)
+def test_parse_args_compression(compression_args, monkeypatch):
+    argv = ["vi_generate_indices", "-i", "in", "-o", "out", "-s", L30_ID_STR]
+    monkeypatch.setattr(sys, "argv", argv + compression_args)
+
+    assert parse_args() == (Path("in"), Path("out"), L30_ID_STR, "zstd")
+
+
+def test_parse_args_invalid_compression(monkeypatch, capsys):
+    argv = ["vi_generate_indices", "-i", "in", "-o", "out", "-s", L30_ID_STR]
+    monkeypatch.setattr(sys, "argv", argv + ["-c", "lzw"])
+
+    with pytest.raises(SystemExit) as exc_info:
+        parse_args()
+
+    assert exc_info.value.code == 2
+    assert "usage:" in capsys.readouterr().err
+
+
+def test_write_granule_indices_zstd(tmp_path: Path):
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    write_l30_granule(input_dir, {}, np.zeros((16, 16), dtype=np.uint8))
+
+    write_granule_indices(output_dir, read_granule_bands(input_dir, L30_ID_STR), "zstd")
+
+    tif_paths = sorted(output_dir.glob("*.tif"))
+    assert len(tif_paths) == len(Index)
+
+    for tif_path in tif_paths:
+        with rasterio.open(tif_path) as tif:
+            assert tif.tags(ns="IMAGE_STRUCTURE")["COMPRESSION"] == "ZSTD"
+
+
+def test_write_granule_indices_invalid_compression(tmp_path: Path):
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    write_l30_granule(input_dir, {}, np.zeros((16, 16), dtype=np.uint8))
+    granule = read_granule_bands(input_dir, L30_ID_STR)
+
+    with pytest.raises(ValueError, match="lzw"):
+        write_granule_indices(output_dir, granule, "lzw")